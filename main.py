@@ -1,31 +1,113 @@
 #!/usr/bin/env python3
+from __future__ import annotations
+
 import argparse
+import asyncio
 import datetime as dt
+import functools
+import gzip
+import hashlib
+import json
 import os
+import sqlite3
 import sys
-from typing import Any, Dict, List
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, TextIO, TypeAlias
 
+import orjson
 import requests
 from dotenv import load_dotenv
-from langchain.output_parsers import PydanticOutputParser
-from langchain.prompts import ChatPromptTemplate
-from langchain_openai import ChatOpenAI
-from pydantic import BaseModel, Field
-from tenacity import retry, stop_after_attempt, wait_exponential
+from requests.adapters import HTTPAdapter
+from tenacity import (
+    retry,
+    retry_if_not_exception_type,
+    stop_after_attempt,
+    wait_exponential,
+)
+
+GITHUB_API = "https://api.github.com/graphql"
+# 出力・要約で使うフィールドだけを取得する
+SEARCH_QUERY = """
+query($q: String!, $n: Int!) {
+  search(query: $q, type: REPOSITORY, first: $n) {
+    nodes {
+      ... on Repository {
+        nameWithOwner
+        url
+        description
+        primaryLanguage { name }
+        stargazerCount
+        createdAt
+        pushedAt
+      }
+    }
+  }
+}
+"""
+# search(first:) の上限。REST の per_page と違い、超えるとエラーになる
+GITHUB_SEARCH_MAX = 100
+# OpenAI のレート制限を考慮した同時要約数の上限
+SUMMARY_CONCURRENCY = 5
+# Batch API の完了確認間隔（秒）
+BATCH_POLL_INTERVAL = 30
 
-GITHUB_API = "https://api.github.com/search/repositories"
+# --slack-fire-and-forget 時に Slack 投稿の完了を待つ上限（秒）
+SLACK_POST_JOIN_TIMEOUT = 5
 
+# GitHub Search の結果キャッシュ（TTL 内は API を呼ばずに返す）
+GITHUB_CACHE_PATH = ".trend_cache.sqlite"
+GITHUB_CACHE_TTL = 3600
 
-class RepoDigest(BaseModel):
-    summary: str = Field(description="技術の要点を2-3文で")
-    why_care: str = Field(description="今使う価値を一言で")
-    use_cases: list[str] = Field(default_factory=list, description="具体用途 最大3")
-    setup: list[str] = Field(default_factory=list, description="最短手順 2-4行")
-    difficulty: int = Field(ge=1, le=5, description="1=易 5=重")
+# 要約キャッシュ。プロンプトを変更したら PROMPT_VERSION を上げて古い要約を無効化する
+DIGEST_CACHE_PATH = "digests.sqlite"
+PROMPT_VERSION = "v1"
 
+# GitHub / Slack で使い回す keep-alive セッション（リトライは tenacity 側で行う）
+_SESSION = requests.Session()
+_SESSION.headers.update({"User-Agent": "trend-daily-script"})
+_SESSION.mount(
+    "https://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=0)
+)
 
-def build_chain():
-    parser = PydanticOutputParser(pydantic_object=RepoDigest)
+
+# langchain / openai / pydantic は import が重いので、要約する時だけ読み込む
+@functools.lru_cache(maxsize=1)
+def _repo_digest_cls():
+    from pydantic import BaseModel, ConfigDict, Field
+
+    class RepoDigest(BaseModel):
+        # 生成後は書き換えない（キャッシュから読んだものを共有しても安全）
+        model_config = ConfigDict(frozen=True)
+
+        summary: str = Field(description="技術の要点を2-3文で")
+        why_care: str = Field(description="今使う価値を一言で")
+        use_cases: list[str] = Field(default_factory=list, description="具体用途 最大3")
+        setup: list[str] = Field(default_factory=list, description="最短手順 2-4行")
+        difficulty: int = Field(ge=1, le=5, description="1=易 5=重")
+
+    return RepoDigest
+
+
+if TYPE_CHECKING:
+    # 実体は _repo_digest_cls() が定義する。注釈用の名前だけを用意する
+    RepoDigest: TypeAlias = Any
+
+
+def __getattr__(name: str) -> Any:
+    if name == "RepoDigest":
+        return _repo_digest_cls()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+@functools.lru_cache(maxsize=1)
+def build_prompt():
+    from langchain.output_parsers import PydanticOutputParser
+    from langchain.prompts import ChatPromptTemplate
+
+    parser = PydanticOutputParser(pydantic_object=_repo_digest_cls())
     prompt = ChatPromptTemplate.from_messages(
         [
             ("system", "あなたは優秀なMLエンジニアの編集者。出力は必ずJSONのみ。"),
@@ -51,31 +133,182 @@ def build_chain():
             ),
         ]
     ).partial(format_instructions=parser.get_format_instructions())
+    return prompt, parser
 
+
+def build_chain():
+    """要約チェーンと、それが使う HTTP クライアント（使い終わったら aclose する）"""
+    import httpx
+    from langchain_openai import ChatOpenAI
+    from openai import DefaultAsyncHttpxClient
+
+    prompt, parser = build_prompt()
+    # 並列要約で接続を使い回すための共有クライアント（SDK の既定設定を引き継ぐ）
+    http_client = DefaultAsyncHttpxClient(
+        limits=httpx.Limits(max_connections=10, max_keepalive_connections=10)
+    )
     llm = ChatOpenAI(
-        model=os.getenv("OPENAI_MODEL"), openai_api_key=os.getenv("OPENAI_API_KEY")
+        model=os.getenv("OPENAI_MODEL"),
+        openai_api_key=os.getenv("OPENAI_API_KEY"),
+        http_async_client=http_client,
+    )
+    return prompt | llm | parser, http_client
+
+
+def prompt_inputs(repo: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        "name": repo["full_name"],
+        "url": repo["html_url"],
+        "desc": (repo.get("description") or "").strip(),
+        "lang": repo.get("language") or "-",
+        "stars": repo.get("stargazers_count", 0),
+    }
+
+
+def _digest_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(DIGEST_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS digests (key TEXT PRIMARY KEY, json TEXT, ts INTEGER)"
     )
-    return prompt | llm | parser
+    return conn
+
+
+def digest_cache_key(repo: Dict[str, Any]) -> str:
+    """同じリポでも push があれば要約し直す"""
+    raw = f"{repo['full_name']}|{repo['pushed_at']}|{PROMPT_VERSION}"
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def load_cached_digest(repo: Dict[str, Any]) -> Optional[RepoDigest]:
+    with closing(_digest_cache()) as cache:
+        row = cache.execute(
+            "SELECT json FROM digests WHERE key = ?", (digest_cache_key(repo),)
+        ).fetchone()
+    return _repo_digest_cls().model_validate_json(row[0]) if row else None
+
+
+def save_cached_digest(repo: Dict[str, Any], d: RepoDigest) -> None:
+    with closing(_digest_cache()) as cache, cache:
+        cache.execute(
+            "INSERT OR REPLACE INTO digests VALUES (?, ?, ?)",
+            (digest_cache_key(repo), d.model_dump_json(), int(time.time())),
+        )
+
+
+async def summarize_with_langchain(repo: Dict[str, Any], chain) -> RepoDigest:
+    cached = load_cached_digest(repo)
+    if cached is not None:
+        return cached
+    d = await chain.ainvoke(prompt_inputs(repo))
+    save_cached_digest(repo, d)
+    return d
+
+
+async def summarize_all(items: List[Dict[str, Any]], chain) -> List[RepoDigest]:
+    """各リポの要約を並列に実行（同時実行数は SUMMARY_CONCURRENCY まで）"""
+    sem = asyncio.Semaphore(SUMMARY_CONCURRENCY)
+
+    async def _bounded(it: Dict[str, Any]) -> RepoDigest:
+        async with sem:
+            return await summarize_with_langchain(it, chain)
+
+    # gather は入力順で結果を返す
+    return await asyncio.gather(*[_bounded(it) for it in items])
 
 
-def summarize_with_langchain(repo: Dict[str, Any], chain) -> RepoDigest:
-    return chain.invoke(
-        {
-            "name": repo["full_name"],
-            "url": repo["html_url"],
-            "desc": (repo.get("description") or "").strip(),
-            "lang": repo.get("language") or "-",
-            "stars": repo.get("stargazers_count", 0),
+async def summarize_and_close(
+    items: List[Dict[str, Any]], chain, http_client
+) -> List[RepoDigest]:
+    try:
+        return await summarize_all(items, chain)
+    finally:
+        await http_client.aclose()
+
+
+def summarize_with_batch_api(items: List[Dict[str, Any]]) -> List[RepoDigest]:
+    """OpenAI Batch API でまとめて要約（完了まで最大24h・料金は半額）"""
+    from openai import OpenAI
+
+    prompt, parser = build_prompt()
+    model = os.getenv("OPENAI_MODEL")
+    roles = {"system": "system", "human": "user", "ai": "assistant"}
+
+    digests: Dict[str, RepoDigest] = {}
+    pending: Dict[str, Dict[str, Any]] = {}
+    for it in items:
+        cached = load_cached_digest(it)
+        if cached is None:
+            pending[it["full_name"]] = it
+        else:
+            digests[it["full_name"]] = cached
+    if not pending:
+        return [digests[it["full_name"]] for it in items]
+
+    lines = []
+    for it in pending.values():
+        messages = prompt.format_messages(**prompt_inputs(it))
+        body = {
+            "model": model,
+            "messages": [
+                {"role": roles[m.type], "content": m.content} for m in messages
+            ],
+            # PydanticOutputParser でそのままパースできるよう JSON を強制
+            "response_format": {"type": "json_object"},
         }
+        lines.append(
+            json.dumps(
+                {
+                    "custom_id": it["full_name"],
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": body,
+                },
+                ensure_ascii=False,
+            )
+        )
+
+    client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    batch_input = client.files.create(
+        file=("digest_batch.jsonl", "\n".join(lines).encode("utf-8")),
+        purpose="batch",
+    )
+    batch = client.batches.create(
+        input_file_id=batch_input.id,
+        endpoint="/v1/chat/completions",
+        completion_window="24h",
     )
+    print(f"[INFO] Batch を作成しました -> {batch.id}")
+
+    while batch.status not in ("completed", "failed", "expired", "cancelled"):
+        time.sleep(BATCH_POLL_INTERVAL)
+        batch = client.batches.retrieve(batch.id)
+    if batch.status != "completed" or not batch.output_file_id:
+        raise RuntimeError(f"OpenAI batch {batch.id} ended with status {batch.status}")
+
+    for line in client.files.content(batch.output_file_id).text.splitlines():
+        if not line.strip():
+            continue
+        res = json.loads(line)
+        content = res["response"]["body"]["choices"][0]["message"]["content"]
+        d = parser.parse(content)
+        save_cached_digest(pending[res["custom_id"]], d)
+        digests[res["custom_id"]] = d
+
+    missing = [it["full_name"] for it in items if it["full_name"] not in digests]
+    if missing:
+        raise RuntimeError(f"OpenAI batch {batch.id} has no result for: {missing}")
+    return [digests[it["full_name"]] for it in items]
 
 
 def slack_block_with_digest(i: int, it: Dict[str, Any], d: RepoDigest) -> str:
+    name = it["full_name"]
+    url = it["html_url"]
+    stars = it["stargazers_count"]
     uc = " ・".join(d.use_cases[:3]) if d.use_cases else "—"
-    setup = "\n".join([f"   - {s}" for s in d.setup[:4]]) if d.setup else ""
+    setup = "\n".join(f"   - {s}" for s in d.setup[:4]) if d.setup else ""
     return (
-        f"{i}. {it['full_name']} ★{it['stargazers_count']}\n"
-        f"   {it['html_url']}\n"
+        f"{i}. {name} ★{stars}\n"
+        f"   {url}\n"
         f"   {d.summary}\n"
         f"   🧠 {d.why_care} / 難易度★{d.difficulty}\n"
         f"   使いどころ: {uc}\n"
@@ -91,13 +324,12 @@ def build_query(language: str, days: int, use_created: bool) -> str:
     return f"language:{language} {date_field}:>={since}"
 
 
-def format_markdown(items: List[Dict[str, Any]], top: int, title: str) -> str:
-    md = [
-        f"# {title}",
-        "",
-        f"実行日時: {dt.datetime.now().isoformat(timespec='seconds')}",
-    ]
-    md.append("")
+def format_markdown(
+    items: List[Dict[str, Any]], top: int, title: str, fp: TextIO
+) -> None:
+    """Markdown を fp に直接書き出す"""
+    fp.write(f"# {title}\n\n")
+    fp.write(f"実行日時: {dt.datetime.now().isoformat(timespec='seconds')}\n")
     for i, it in enumerate(items[:top], 1):
         name = it["full_name"]
         url = it["html_url"]
@@ -106,45 +338,116 @@ def format_markdown(items: List[Dict[str, Any]], top: int, title: str) -> str:
         lang = it.get("language") or "-"
         created = it["created_at"]
         pushed = it["pushed_at"]
-        md.extend(
-            [
-                f"## {i}. [{name}]({url})  ★{stars}",
-                f"- 言語: `{lang}`",
-                f"- created: `{created}` / pushed: `{pushed}`",
-                f"- 概要: {desc or '—'}",
-                "",
-            ]
+        fp.write(
+            f"\n## {i}. [{name}]({url})  ★{stars}\n"
+            f"- 言語: `{lang}`\n"
+            f"- created: `{created}` / pushed: `{pushed}`\n"
+            f"- 概要: {desc or '—'}\n"
         )
-    return "\n".join(md)
 
 
 def post_slack(webhook: str, text: str) -> None:
-    payload = {"text": text}
-    r = requests.post(webhook, json=payload, timeout=20)
+    payload = orjson.dumps({"text": text})
+    r = _SESSION.post(
+        webhook,
+        data=payload,
+        headers={"Content-Type": "application/json"},
+        timeout=20,
+    )
     r.raise_for_status()
 
 
-@retry(wait=wait_exponential(min=2, max=20), stop=stop_after_attempt(3))
+def _post_slack_quietly(webhook: str, text: str) -> None:
+    # --slack-fire-and-forget 用。失敗しても実行自体は失敗させず警告だけ出す
+    try:
+        post_slack(webhook, text)
+    except requests.RequestException as e:
+        print(f"WARN: Slack 投稿に失敗しました: {e}", file=sys.stderr)
+
+
+def _github_cache() -> sqlite3.Connection:
+    conn = sqlite3.connect(GITHUB_CACHE_PATH)
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS search_results"
+        " (key TEXT PRIMARY KEY, body BLOB, ts INTEGER)"
+    )
+    return conn
+
+
+class GitHubQueryError(RuntimeError):
+    """クエリや引数の誤りなど、リトライしても成功しない GraphQL エラー"""
+
+
+@retry(
+    wait=wait_exponential(min=2, max=20),
+    stop=stop_after_attempt(3),
+    retry=retry_if_not_exception_type(GitHubQueryError),
+)
 def search_repos(token: str, query: str, per_page: int) -> Dict[str, Any]:
-    headers = {
-        "Authorization": f"Bearer {token}",
-        "Accept": "application/vnd.github+json",
-        "User-Agent": "trend-daily-script",
-    }
-    params = {"q": query, "sort": "stars", "order": "desc", "per_page": per_page}
-    r = requests.get(GITHUB_API, headers=headers, params=params, timeout=30)
-    # Rate limit 時はリトライ
-    if r.status_code == 403 and "rate limit" in r.text.lower():
-        raise RuntimeError("GitHub API rate limited")
-    r.raise_for_status()
-    return r.json()
+    per_page = min(per_page, GITHUB_SEARCH_MAX)
+    key = hashlib.sha256(f"{query}|{per_page}".encode()).hexdigest()
+    with closing(_github_cache()) as cache:
+        row = cache.execute(
+            "SELECT body, ts FROM search_results WHERE key = ?", (key,)
+        ).fetchone()
+        if row and time.time() - row[1] < GITHUB_CACHE_TTL:
+            return orjson.loads(gzip.decompress(row[0]))
+
+        headers = {"Authorization": f"Bearer {token}"}
+        payload = {
+            "query": SEARCH_QUERY,
+            "variables": {"q": f"{query} sort:stars-desc", "n": per_page},
+        }
+        r = _SESSION.post(GITHUB_API, headers=headers, json=payload, timeout=30)
+        body = orjson.loads(r.content) if r.status_code == 200 else {}
+        errors = body.get("errors")
+        # Rate limit 時はヘッダの解除時刻（二次制限は Retry-After）まで待ってリトライ。
+        # GraphQL の一次制限は 200 + errors[].type == "RATE_LIMITED" で返る
+        if r.status_code in (403, 429) or any(
+            e.get("type") == "RATE_LIMITED" for e in errors or []
+        ):
+            if "Retry-After" in r.headers:
+                time.sleep(int(r.headers["Retry-After"]))
+                raise RuntimeError("GitHub API secondary rate limited")
+            if r.headers.get("X-RateLimit-Remaining") == "0":
+                reset = int(r.headers["X-RateLimit-Reset"])
+                time.sleep(max(0, reset - time.time()) + 1)
+                raise RuntimeError("GitHub API rate limited")
+        r.raise_for_status()
+        if errors:
+            # リトライするのはレート制限だけ
+            if all(e.get("type") == "RATE_LIMITED" for e in errors):
+                raise RuntimeError(f"GitHub GraphQL error: {errors}")
+            raise GitHubQueryError(f"GitHub GraphQL error: {errors}")
+
+        # 後段は REST のフィールド名を前提にしているので揃える
+        items = [
+            {
+                "full_name": node["nameWithOwner"],
+                "html_url": node["url"],
+                "description": node["description"],
+                "language": (node["primaryLanguage"] or {}).get("name"),
+                "stargazers_count": node["stargazerCount"],
+                "created_at": node["createdAt"],
+                "pushed_at": node["pushedAt"],
+            }
+            for node in body["data"]["search"]["nodes"]
+            if node
+        ]
+        data = {"items": items}
+        with cache:
+            cache.execute(
+                "INSERT OR REPLACE INTO search_results VALUES (?, ?, ?)",
+                (key, gzip.compress(orjson.dumps(data)), int(time.time())),
+            )
+        return data
 
 
 def main():
     load_dotenv()
 
     parser = argparse.ArgumentParser(
-        description="Fetch pseudo-trending repos via GitHub Search API."
+        description="Fetch pseudo-trending repos via GitHub GraphQL search."
     )
     parser.add_argument(
         "--language", default="Python", help="言語フィルタ（例: Python, TypeScript）"
@@ -154,7 +457,10 @@ def main():
     )
     parser.add_argument("--top", type=int, default=5, help="上位何件を表示するか")
     parser.add_argument(
-        "--per-page", type=int, default=30, help="APIから取得する最大件数（上位抽出用）"
+        "--per-page",
+        type=int,
+        default=30,
+        help="APIから取得する最大件数（上位抽出用・最大100）",
     )
     parser.add_argument(
         "--use-created",
@@ -169,6 +475,19 @@ def main():
         action="store_true",
         help="Slackに投稿する（SLACK_WEBHOOK_URL が必要）",
     )
+    parser.add_argument(
+        "--batch-api",
+        action="store_true",
+        help="要約に OpenAI Batch API を使う（半額・完了まで最大24h。定期実行向け）",
+    )
+    parser.add_argument(
+        "--slack-fire-and-forget",
+        action="store_true",
+        help=(
+            f"Slack 投稿を最大{SLACK_POST_JOIN_TIMEOUT}秒しか待たない"
+            "（--slack と併用。失敗・未完了は警告のみ）"
+        ),
+    )
     parser.add_argument(
         "--title", default="今日のGitHubトレンド", help="Markdown/Slack見出し"
     )
@@ -182,7 +501,24 @@ def main():
         )
         sys.exit(1)
 
+    webhook = os.getenv("SLACK_WEBHOOK_URL") if args.slack else None
+    use_batch = bool(webhook) and args.batch_api
+    if use_batch and sys.stdin.isatty():
+        # 対話実行で最大24h待たせないよう通常の API にフォールバック
+        print(
+            "WARN: 対話実行のため --batch-api を無視して通常の API で要約します。",
+            file=sys.stderr,
+        )
+        use_batch = False
+
     query = build_query(args.language, args.days, args.use_created)
+    fut_chain = None
+    if webhook and not use_batch:
+        # LangChain/OpenAI クライアントの初期化を GitHub 検索と重ねる。
+        # 結果は Slack 投稿時に受け取るので、初期化に失敗してもコンソール/Markdown は出る
+        ex = ThreadPoolExecutor(1)
+        fut_chain = ex.submit(build_chain)
+        ex.shutdown(wait=False)
     data = search_repos(token, query, args.per_page)
     items = data.get("items", [])
 
@@ -192,31 +528,51 @@ def main():
 
     # Markdown
     if args.markdown_out:
-        md = format_markdown(items, args.top, args.title)
-        with open(args.markdown_out, "w", encoding="utf-8") as f:
-            f.write(md)
+        with open(args.markdown_out, "w", encoding="utf-8", buffering=1024 * 1024) as f:
+            format_markdown(items, args.top, args.title, f)
         print(f"\n[INFO] Markdown を書き出しました -> {args.markdown_out}")
 
     # Slack
     if args.slack:
-        webhook = os.getenv("SLACK_WEBHOOK_URL")
         if not webhook:
             print(
                 "WARN: SLACK_WEBHOOK_URL が未設定のため Slack 投稿をスキップしました。",
                 file=sys.stderr,
             )
         else:
-            chain = build_chain()
+            top_items = items[: args.top]
+            if use_batch:
+                digests = summarize_with_batch_api(top_items)
+            else:
+                chain, http_client = fut_chain.result()
+                digests = asyncio.run(
+                    summarize_and_close(top_items, chain, http_client)
+                )
             text_lines = [args.title, ""]
 
-            for i, it in enumerate(items[: args.top], 1):
-                d = summarize_with_langchain(it, chain)
+            for i, (it, d) in enumerate(zip(top_items, digests), 1):
                 text_lines.append(slack_block_with_digest(i, it, d))
 
                 text_lines.append(f"   {(it.get('description') or '').strip()}")
 
-            post_slack(webhook, "\n".join(text_lines))
-            print("[INFO] Slack に投稿しました。")
+            text = "\n".join(text_lines)
+            if args.slack_fire_and_forget:
+                # daemon スレッドなので、待つのは SLACK_POST_JOIN_TIMEOUT 秒まで
+                t = threading.Thread(
+                    target=_post_slack_quietly, args=(webhook, text), daemon=True
+                )
+                t.start()
+                t.join(SLACK_POST_JOIN_TIMEOUT)
+                if t.is_alive():
+                    print(
+                        "WARN: Slack 投稿の完了を待たずに終了します。",
+                        file=sys.stderr,
+                    )
+                else:
+                    print("[INFO] Slack 投稿処理を終えました。")
+            else:
+                post_slack(webhook, text)
+                print("[INFO] Slack に投稿しました。")
 
 
 if __name__ == "__main__":